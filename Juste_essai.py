@@ -1,8 +1,18 @@
 import csv
+import fnmatch
+import hashlib
+import heapq
 import json
+import marshal
+import math
+import mmap
 import os
+import re
+import shutil
+import struct
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
+from itertools import repeat
 
 # ---------------------------
 # Utilitaires
@@ -16,29 +26,56 @@ def gen_id():
     """Génère un identifiant unique."""
     return str(uuid.uuid4())
 
-def safe_read_json(path):
-    """Charge un fichier JSON de manière sécurisée."""
+def safe_read_json(path, strict=False):
+    """Charge un fichier JSON de manière sécurisée (via l'instantané binaire s'il est à jour).
+
+    Un fichier absent donne []. Un fichier illisible donne [] aussi, sauf avec
+    strict=True où None est retourné pour que l'appelant puisse s'arrêter.
+    """
     if not os.path.exists(path):
         return []
+    data = lire_snapshot(path)
+    if data is not None:
+        return data
     try:
         with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError):
+            data = json.load(f)
+    except (json.JSONDecodeError, IOError, UnicodeDecodeError):
         print(f"Impossible de lire le fichier JSON : {path} .")
-        return []
-
-def safe_write_json(path, data):
-    """Crée un fichier JSON de manière sécurisée."""
+        return None if strict else []
+    ecrire_snapshot(path, data)
+    return data
+
+def safe_write_json(path, data, indent=4):
+    """Crée un fichier JSON de manière sécurisée et met à jour son instantané binaire.
+
+    Le contenu est écrit dans un fichier temporaire qui remplace ensuite l'original :
+    en cas d'échec, l'ancien fichier reste intact. Retourne True si l'écriture a réussi.
+    indent=None produit un fichier compact (une seule ligne, sans espaces superflus).
+    """
+    separators = (",", ":") if indent is None else None
+    tmp = path + ".tmp"
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-    except IOError:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=indent, separators=separators, ensure_ascii=False)
+        os.replace(tmp, path)
+    except (IOError, TypeError, ValueError):
         print(f"Échec d'écriture du fichier JSON : {path}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
+    ecrire_snapshot(path, data)
+    return True
 
 def safe_read_csv(path, fieldnames):
-    """Charge un fichier CSV de manière sécurisée."""
+    """Charge un fichier CSV de manière sécurisée (via l'instantané binaire s'il est à jour)."""
     if not os.path.exists(path):
         return []
+    result = lire_snapshot(path, fieldnames)
+    if result is not None:
+        return result
     try:
         with open(path, "r", newline="", encoding="utf-8") as f:
             reader = csv.DictReader(f)
@@ -46,20 +83,31 @@ def safe_read_csv(path, fieldnames):
             for row in reader:
                 r = {k: row.get(k, "") for k in fieldnames}
                 result.append(r)
-            return result
     except Exception as e:
         print(f"Impossible de lire le fichier CSV {path}, l'erreur : {e}")
         return []
+    ecrire_snapshot(path, result, fieldnames)
+    return result
 
 def safe_write_csv(path, fieldnames, rows):
-    """Crée un fichier CSV de manière sécurisée."""
+    """Crée un fichier CSV de manière sécurisée et met à jour son instantané binaire.
+
+    Les valeurs sont extraites une seule fois par colonne : ces colonnes alimentent
+    l'écriture du CSV (ligne par ligne, sans copie) puis directement l'instantané.
+    """
     try:
+        try:
+            colonnes = [[r[k] for r in rows] for k in fieldnames]
+        except KeyError:
+            colonnes = [[r.get(k, "") for r in rows] for k in fieldnames]
         with open(path, "w", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(rows)
+            writer = csv.writer(f)
+            writer.writerow(fieldnames)
+            writer.writerows(zip(*colonnes))
     except Exception as e:
         print(f"Impossible d'écrire le CSV {path} : {e}")
+        return
+    ecrire_snapshot_colonnes(path, fieldnames, colonnes, len(rows))
 
 def to_int(val, default=0):
     """Convertit une valeur en entier ou retourne une valeur par défaut."""
@@ -75,6 +123,226 @@ def to_float(val, default=0.0):
     except Exception:
         return default
 
+# ---------------------------
+# Instantané binaire
+# ---------------------------
+#
+# Chaque fichier texte (CSV/JSON) est doublé d'un fichier "<fichier>.snap" :
+#   en-tête : MAGIC | version marshal | mtime_ns | ctime_ns | taille source | taille index
+#   index   : dictionnaire marshal {"mode", "lignes", "colonnes": [(nom, offset, longueur, format)]}
+#   blocs   : un bloc par colonne (ou un seul bloc "__data__" si les données ne
+#             sont pas une liste d'enregistrements). Format "t" : chaînes UTF-8
+#             séparées par SNAPSHOT_SEP (aussi compact qu'un CSV) ; format "m" :
+#             liste marshal, pour les autres types de valeurs.
+# Le fichier est lu par mmap : seules les colonnes demandées sont décodées.
+# L'instantané n'est valide que si mtime, ctime et taille du fichier source
+# correspondent (ctime ne peut pas être restauré par cp -p / rsync -a) ; sinon il
+# est reconstruit à la prochaine lecture du fichier texte. Un instantané plus
+# volumineux que sa source n'est pas conservé.
+
+SNAPSHOT_EXT = ".snap"
+SNAPSHOT_MAGIC = b"GINVSNP2"
+SNAPSHOT_HEADER = struct.Struct("<8sIqqqI")
+# Marqueur d'une clé absente dans le mode "creuses" (JSON ne produit jamais Ellipsis).
+SNAPSHOT_ABSENT = ...
+SNAPSHOT_SEP = "\x1f"
+
+def snapshot_path(path):
+    """Retourne le chemin de l'instantané binaire associé à un fichier."""
+    return path + SNAPSHOT_EXT
+
+def _signature_fichier(path):
+    """Retourne (mtime_ns, ctime_ns, taille) du fichier source, ou None s'il est absent."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_ctime_ns, st.st_size
+
+def _colonnes_json(data):
+    """Retourne (mode, clés) pour une liste de dicts, ou (None, None) pour toute autre donnée.
+
+    Mode "colonnes" si tous les enregistrements ont les mêmes clés, "creuses" sinon
+    (union des clés, les valeurs absentes étant marquées par SNAPSHOT_ABSENT).
+    """
+    if not isinstance(data, list) or not data or not all(isinstance(d, dict) for d in data):
+        return None, None
+    cles = dict.fromkeys(data[0])
+    homogene = True
+    for d in data:
+        if len(d) != len(cles) or any(k not in cles for k in d):
+            homogene = False
+            cles.update(dict.fromkeys(d))
+    return ("colonnes" if homogene else "creuses"), list(cles)
+
+def _encoder_colonne(valeurs, texte_seul=False):
+    """Encode une colonne : texte joint si toutes les valeurs sont des chaînes, marshal sinon.
+
+    texte_seul=True (colonnes de CSV) convertit d'abord les autres valeurs en
+    chaînes, comme le ferait une relecture du CSV.
+    """
+    try:
+        texte = SNAPSHOT_SEP.join(valeurs)
+    except TypeError:
+        if not texte_seul:
+            return "m", marshal.dumps(valeurs)
+        valeurs = ["" if v is None else str(v) for v in valeurs]
+        texte = SNAPSHOT_SEP.join(valeurs)
+    if texte.count(SNAPSHOT_SEP) == max(len(valeurs) - 1, 0):
+        return "t", texte.encode("utf-8")
+    return "m", marshal.dumps(valeurs)
+
+def _supprimer_snapshot(path):
+    try:
+        os.remove(snapshot_path(path))
+    except OSError:
+        pass
+
+def _ecrire_blocs(path, mode, nb_lignes, blocs):
+    """Assemble et écrit l'instantané à partir de blocs (nom, format, octets)."""
+    signature = _signature_fichier(path)
+    if signature is None:
+        return
+    try:
+        entrees, offset = [], 0
+        for nom, format_bloc, bloc in blocs:
+            entrees.append((nom, offset, len(bloc), format_bloc))
+            offset += len(bloc)
+        index = marshal.dumps({"mode": mode, "lignes": nb_lignes, "colonnes": entrees})
+        if SNAPSHOT_HEADER.size + len(index) + offset > signature[2]:
+            # Aucun gain à attendre : la source sera relue directement.
+            _supprimer_snapshot(path)
+            return
+        tmp = snapshot_path(path) + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, marshal.version, signature[0],
+                                         signature[1], signature[2], len(index)))
+            f.write(index)
+            for _, _, bloc in blocs:
+                f.write(bloc)
+        os.replace(tmp, snapshot_path(path))
+    except (ValueError, OSError) as e:
+        print(f"Impossible d'écrire l'instantané de {path} : {e}")
+
+def ecrire_snapshot_colonnes(path, fieldnames, colonnes, nb_lignes):
+    """Écrit l'instantané d'un CSV à partir de ses colonnes (une séquence par champ)."""
+    try:
+        blocs = [(nom,) + _encoder_colonne(col, texte_seul=True) for nom, col in zip(fieldnames, colonnes)]
+    except ValueError as e:
+        print(f"Impossible d'écrire l'instantané de {path} : {e}")
+        return
+    _ecrire_blocs(path, "colonnes", nb_lignes, blocs)
+
+def ecrire_snapshot(path, data, fieldnames=None):
+    """Écrit l'instantané binaire de data, lié à l'état courant du fichier source."""
+    if fieldnames is not None:
+        colonnes = [[d.get(nom, "") for d in data] for nom in fieldnames]
+        ecrire_snapshot_colonnes(path, fieldnames, colonnes, len(data))
+        return
+    mode, colonnes = _colonnes_json(data)
+    try:
+        if mode == "colonnes":
+            blocs = [(nom,) + _encoder_colonne([d[nom] for d in data]) for nom in colonnes]
+        elif mode == "creuses":
+            blocs = [(nom, "m", marshal.dumps([d.get(nom, SNAPSHOT_ABSENT) for d in data])) for nom in colonnes]
+        else:
+            mode = "data"
+            blocs = [("__data__", "m", marshal.dumps(data))]
+    except ValueError as e:
+        print(f"Impossible d'écrire l'instantané de {path} : {e}")
+        return
+    _ecrire_blocs(path, mode, len(data) if isinstance(data, list) else 0, blocs)
+
+def _ouvrir_snapshot(path):
+    """Ouvre l'instantané s'il est valide : retourne (mmap, index, début des blocs) ou None."""
+    signature = _signature_fichier(path)
+    if signature is None:
+        return None
+    try:
+        with open(snapshot_path(path), "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        magic, version, mtime_ns, ctime_ns, taille, taille_index = SNAPSHOT_HEADER.unpack_from(mm, 0)
+        if (magic != SNAPSHOT_MAGIC or version != marshal.version or
+                (mtime_ns, ctime_ns, taille) != signature):
+            mm.close()
+            return None
+        debut = SNAPSHOT_HEADER.size + taille_index
+        index = marshal.loads(mm[SNAPSHOT_HEADER.size:debut])
+        return mm, index, debut
+    except (struct.error, ValueError, EOFError, TypeError):
+        mm.close()
+        return None
+
+def _decoder_bloc(mm, debut, index, offset, longueur, format_bloc):
+    bloc = mm[debut + offset:debut + offset + longueur]
+    if format_bloc == "t":
+        return bloc.decode("utf-8").split(SNAPSHOT_SEP) if index["lignes"] else []
+    return marshal.loads(bloc)
+
+def lire_colonnes_snapshot(path, colonnes):
+    """Lit uniquement les colonnes demandées d'un instantané valide (dict nom -> liste) ou None."""
+    ouvert = _ouvrir_snapshot(path)
+    if ouvert is None:
+        return None
+    mm, index, debut = ouvert
+    try:
+        if index["mode"] != "colonnes":
+            return None
+        table = {entree[0]: entree[1:] for entree in index["colonnes"]}
+        if any(nom not in table for nom in colonnes):
+            return None
+        return {nom: _decoder_bloc(mm, debut, index, *table[nom]) for nom in colonnes}
+    except (ValueError, EOFError, TypeError, KeyError):
+        return None
+    finally:
+        mm.close()
+
+def lire_snapshot(path, fieldnames=None):
+    """Reconstruit les données d'un instantané valide, ou retourne None s'il faut relire le texte."""
+    ouvert = _ouvrir_snapshot(path)
+    if ouvert is None:
+        return None
+    mm, index, debut = ouvert
+    try:
+        mode = index["mode"]
+        if mode == "data":
+            return _decoder_bloc(mm, debut, index, *index["colonnes"][0][1:])
+        noms = [entree[0] for entree in index["colonnes"]]
+        if fieldnames is not None and (mode != "colonnes" or noms != list(fieldnames)):
+            return None
+        valeurs = [_decoder_bloc(mm, debut, index, *entree[1:]) for entree in index["colonnes"]]
+    except (ValueError, EOFError, TypeError, KeyError, IndexError):
+        return None
+    finally:
+        mm.close()
+    if mode == "creuses":
+        return [{k: v for k, v in zip(noms, ligne) if v is not SNAPSHOT_ABSENT} for ligne in zip(*valeurs)]
+    return list(map(dict, map(zip, repeat(noms), zip(*valeurs))))
+
+def lire_colonnes_csv(path, fieldnames, colonnes):
+    """Retourne les colonnes demandées d'un CSV, sans reconstruire les lignes si l'instantané est à jour."""
+    if not os.path.exists(path):
+        return {nom: [] for nom in colonnes}
+    valeurs = lire_colonnes_snapshot(path, colonnes)
+    if valeurs is not None:
+        return valeurs
+    lignes = safe_read_csv(path, fieldnames)
+    return {nom: [l.get(nom, "") for l in lignes] for nom in colonnes}
+
+def lire_lignes_csv(path, fieldnames, indices):
+    """Reconstruit uniquement les lignes d'un CSV dont les positions sont données.
+
+    À utiliser après une sélection faite avec lire_colonnes_csv : seules les lignes
+    retenues sont transformées en dictionnaires.
+    """
+    if not indices:
+        return []
+    colonnes = lire_colonnes_csv(path, fieldnames, fieldnames)
+    return [{nom: colonnes[nom][i] for nom in fieldnames} for i in indices]
+
 # ---------------------------
 # Classes
 # ---------------------------
@@ -246,6 +514,15 @@ class Product:
     CSV_FILE = "gestion_inventaire.csv"
     FIELDNAMES = ["ID", "name", "description", "category_id", "supplier_id",
                 "price", "cost", "quantity", "min_quantity", "SKU", "created_at", "updated_at"]
+    CHAMPS_ENTIERS = ("quantity", "min_quantity")
+    CHAMPS_DECIMAUX = ("price", "cost")
+    CHAMPS_PROTEGES = ("ID", "created_at", "updated_at")
+    # Champs servant à identifier un produit : une modification en masse ne peut
+    # pas donner la même valeur à plusieurs produits.
+    CHAMPS_UNIQUES = ("name", "SKU")
+    FILTRES_MASSE = ("categorie", "fournisseur", "prix_min", "prix_max", "stock_faible", "motif")
+    # "champ = valeur", "champ += valeur", "champ -= valeur", "champ *= valeur", "champ /= valeur"
+    AFFECTATION_RE = re.compile(r"^\s*(\w+)\s*([+\-*/]?=)\s*(.*?)\s*$")
 
     def __init__(self, id=None, name="", description="", category_id="", supplier_id="", price=0.0, cost=0.0,
                 quantity=0, min_quantity=0, SKU="", created_at=None, updated_at=None):
@@ -266,6 +543,17 @@ class Product:
     def _charger_produits():
         return safe_read_csv(Product.CSV_FILE, Product.FIELDNAMES)
 
+    @staticmethod
+    def _selectionner_produits(colonnes, predicat):
+        """Filtre les produits en ne lisant que les colonnes utiles au prédicat.
+
+        predicat reçoit les valeurs des colonnes demandées, dans l'ordre. Retourne
+        (nombre total de produits, lignes complètes des produits retenus).
+        """
+        valeurs = lire_colonnes_csv(Product.CSV_FILE, Product.FIELDNAMES, colonnes)
+        indices = [i for i, ligne in enumerate(zip(*(valeurs[nom] for nom in colonnes))) if predicat(*ligne)]
+        return len(valeurs[colonnes[0]]), lire_lignes_csv(Product.CSV_FILE, Product.FIELDNAMES, indices)
+
     def ajouter_produit(self):
         """Ajoute un produit à la gestion de l'inventaire."""
         if not self.name:
@@ -316,15 +604,13 @@ class Product:
     @staticmethod
     def rechercher_produit(a_rechercher):
         """Recherche un produit par ID, nom ou SKU."""
-        produits = Product._charger_produits()
-        for ligne in produits:
-            if (
-                a_rechercher.strip().lower() == ligne.get("ID", "").strip().lower() or
-                a_rechercher.strip().lower() == ligne.get("name", "").strip().lower() or
-                a_rechercher.strip().lower() == ligne.get("SKU", "").strip().lower()
-            ):
-                print(f"Produit trouvé : {ligne}")
-                return
+        cible = a_rechercher.strip().lower()
+        _, trouves = Product._selectionner_produits(
+            ("ID", "name", "SKU"),
+            lambda produit_id, name, sku: cible in (produit_id.strip().lower(), name.strip().lower(), sku.strip().lower()))
+        if trouves:
+            print(f"Produit trouvé : {trouves[0]}")
+            return
         print("Aucun produit trouvé.")
 
     @staticmethod
@@ -361,32 +647,29 @@ class Product:
             print(f"Produit '{nom_produit}' introuvable.")
             return
         safe_write_csv(Product.CSV_FILE, Product.FIELDNAMES, nouvelle_liste)
+        for p in produits:
+            if p.get("name", "").strip().lower() == nom_produit.strip().lower():
+                LotManager.supprimer(p.get("ID", ""))
         print(f"Produit '{nom_produit}' supprimé avec succès.")
 
     @staticmethod
     def produits_par_categorie(category_name_or_id):
         """Affiche les produits d'une catégorie donnée."""
-        produits = Product._charger_produits()
-        if not produits:
+        cible = category_name_or_id.strip().lower()
+        total, trouves = Product._selectionner_produits(
+            ("category_id",), lambda category_id: category_id.strip().lower() == cible)
+        if not total:
             print("Aucun produit enregistré.")
             return
-        trouve = False
         print(f"\nProduits de la catégorie '{category_name_or_id}' :")
-        for ligne in produits:
-            if ligne.get("category_id", "").strip().lower() == category_name_or_id.strip().lower():
-                print(ligne)
-                trouve = True
-        if not trouve:
+        for ligne in trouves:
+            print(ligne)
+        if not trouves:
             print("Aucun produit trouvé dans cette catégorie.")
 
     @staticmethod
     def produits_par_fournisseur(fournisseur_name_or_id):
         """Affiche les produits d'un fournisseur donné."""
-        produits = Product._charger_produits()
-        if not produits:
-            print("Aucun produit enregistré.")
-            return
-
         fournisseurs = Fournisseur._charger_fournisseurs()
         fournisseur_id = fournisseur_name_or_id
         for f in fournisseurs:
@@ -394,38 +677,593 @@ class Product:
                 fournisseur_id = f.get("ID", "")
                 break
 
-        trouve = False
+        cible = fournisseur_id.strip().lower()
+        total, trouves = Product._selectionner_produits(
+            ("supplier_id",), lambda supplier_id: supplier_id.strip().lower() == cible)
+        if not total:
+            print("Aucun produit enregistré.")
+            return
         print(f"\nProduits du fournisseur '{fournisseur_name_or_id}' :")
-        for ligne in produits:
-            if ligne.get("supplier_id", "").strip().lower() == fournisseur_id.strip().lower():
-                print(ligne)
-                trouve = True
-        if not trouve:
+        for ligne in trouves:
+            print(ligne)
+        if not trouves:
             print("Aucun produit trouvé pour ce fournisseur.")
 
     @staticmethod
     def produits_stock_faible():
         """Affiche les produits en rupture ou avec un stock faible."""
-        produits = Product._charger_produits()
-        if not produits:
+        def stock_faible(quantity, min_quantity):
+            try:
+                return int(quantity) <= int(min_quantity)
+            except ValueError:
+                return False
+
+        total, trouves = Product._selectionner_produits(("quantity", "min_quantity"), stock_faible)
+        if not total:
             print("Aucun produit enregistré.")
             return
         print("\nProduits en rupture ou stock faible :")
-        trouve = False
+        for ligne in trouves:
+            print(ligne)
+        if not trouves:
+            print("Aucun produit en rupture ou stock faible.")
+
+    @staticmethod
+    def _analyser_affectations(affectations):
+        """Transforme les expressions d'affectation en triplets (champ, opérateur, valeur).
+
+        Une paire de guillemets (simples ou doubles) entourant la valeur est retirée.
+        Sous forme de chaîne, les affectations sont séparées par ';' : une valeur
+        contenant ';' doit donc être passée dans une liste d'affectations.
+        Retourne None (après affichage de l'erreur) si une expression est invalide.
+        """
+        if isinstance(affectations, str):
+            affectations = [a for a in affectations.split(";") if a.strip()]
+        resultat = []
+        for expression in affectations:
+            m = Product.AFFECTATION_RE.match(expression)
+            if not m:
+                print(f"Affectation invalide : '{expression}' (ex. 'price *= 1.03').")
+                return None
+            champ, op, valeur = m.groups()
+            if len(valeur) >= 2 and valeur[0] == valeur[-1] and valeur[0] in "'\"":
+                valeur = valeur[1:-1]
+            if champ not in Product.FIELDNAMES or champ in Product.CHAMPS_PROTEGES:
+                print(f"Le champ '{champ}' n'est pas modifiable.")
+                return None
+            if champ in Product.CHAMPS_ENTIERS + Product.CHAMPS_DECIMAUX:
+                try:
+                    valeur = float(valeur)
+                except ValueError:
+                    print(f"Valeur numérique attendue pour '{champ}' : '{valeur}'.")
+                    return None
+                if not math.isfinite(valeur):
+                    print(f"Valeur numérique finie attendue pour '{champ}' : '{valeur}'.")
+                    return None
+                if op == "/=" and valeur == 0:
+                    print(f"Division par zéro pour le champ '{champ}'.")
+                    return None
+            elif op != "=":
+                print(f"L'opérateur '{op}' n'est possible que sur un champ numérique.")
+                return None
+            resultat.append((champ, op, valeur))
+        if not resultat:
+            print("Aucune affectation fournie.")
+            return None
+        return resultat
+
+    @staticmethod
+    def _identifiants(fichier_json, name_or_id):
+        """Retourne l'ensemble des valeurs (saisie, ID, nom) désignant une catégorie ou un fournisseur."""
+        cible = name_or_id.strip().lower()
+        valeurs = {cible}
+        for e in safe_read_json(fichier_json):
+            if cible in (e.get("ID", "").strip().lower(), e.get("name", "").strip().lower()):
+                valeurs.add(e.get("ID", "").strip().lower())
+                valeurs.add(e.get("name", "").strip().lower())
+        return valeurs
+
+    @staticmethod
+    def _filtre_masse(categorie=None, fournisseur=None, prix_min=None, prix_max=None,
+                      stock_faible=False, motif=None):
+        """Construit le prédicat de sélection d'une modification en masse.
+
+        Retourne None (après affichage de l'erreur) si une borne de prix est invalide.
+        """
+        bornes = []
+        for libelle, borne in (("minimum", prix_min), ("maximum", prix_max)):
+            if borne in (None, ""):
+                bornes.append(None)
+                continue
+            valeur = to_float(borne, None)
+            if valeur is None:
+                print(f"Prix {libelle} invalide : '{borne}'.")
+                return None
+            bornes.append(valeur)
+        prix_min, prix_max = bornes
+        if prix_min is not None and prix_max is not None and prix_min > prix_max:
+            print(f"Le prix minimum ({prix_min}) dépasse le prix maximum ({prix_max}).")
+            return None
+        categories = Product._identifiants(Category.JSON_FILE, categorie) if categorie else None
+        fournisseurs = Product._identifiants(Fournisseur.JSON_FILE, fournisseur) if fournisseur else None
+        motif = motif.strip().lower() if motif else None
+
+        def selectionne(ligne):
+            if categories is not None and ligne.get("category_id", "").strip().lower() not in categories:
+                return False
+            if fournisseurs is not None and ligne.get("supplier_id", "").strip().lower() not in fournisseurs:
+                return False
+            prix = to_float(ligne.get("price", ""), 0.0)
+            if prix_min is not None and prix < prix_min:
+                return False
+            if prix_max is not None and prix > prix_max:
+                return False
+            if stock_faible and to_int(ligne.get("quantity", ""), 0) > to_int(ligne.get("min_quantity", ""), 0):
+                return False
+            if motif and not fnmatch.fnmatchcase(ligne.get("name", "").strip().lower(), motif):
+                return False
+            return True
+
+        return selectionne
+
+    @staticmethod
+    def _appliquer_affectation(ancienne, op, valeur, champ):
+        """Calcule la nouvelle valeur (chaîne) d'un champ après une affectation.
+
+        Retourne None si le résultat numérique n'est pas fini (dépassement de capacité).
+        """
+        if champ not in Product.CHAMPS_ENTIERS + Product.CHAMPS_DECIMAUX:
+            return str(valeur)
+        actuelle = to_float(ancienne, 0.0)
+        if op == "=":
+            nouvelle = valeur
+        elif op == "+=":
+            nouvelle = actuelle + valeur
+        elif op == "-=":
+            nouvelle = actuelle - valeur
+        elif op == "*=":
+            nouvelle = actuelle * valeur
+        else:
+            nouvelle = actuelle / valeur
+        if not math.isfinite(nouvelle):
+            return None
+        if champ in Product.CHAMPS_ENTIERS:
+            return str(max(0, int(round(nouvelle))))
+        return str(nouvelle)
+
+    @staticmethod
+    def modifier_produits_en_masse(affectations, simulation=False, **filtres):
+        """Modifie en une seule passe (et une seule écriture) tous les produits filtrés.
+
+        affectations : liste (ou chaîne séparée par ';') d'expressions comme
+        "price *= 1.03", "min_quantity = 10" ou "description = 'Fruit frais'".
+        filtres : categorie, fournisseur, prix_min, prix_max, stock_faible, motif
+        (motif de nom de type "pom*"). Sans filtre, tous les produits sont visés.
+        simulation=True affiche un aperçu sans rien écrire.
+        Retourne le nombre de produits modifiés (ou qui le seraient).
+        """
+        inconnus = [f for f in filtres if f not in Product.FILTRES_MASSE]
+        if inconnus:
+            print(f"Filtre(s) inconnu(s) : {', '.join(inconnus)}. Filtres possibles : {', '.join(Product.FILTRES_MASSE)}.")
+            return 0
+        operations = Product._analyser_affectations(affectations)
+        if operations is None:
+            return 0
+        selectionne = Product._filtre_masse(**filtres)
+        if selectionne is None:
+            return 0
+
+        produits = Product._charger_produits()
+        maintenant = now_iso()
+        selection, modifies, apercu = 0, 0, []
+        selectionne_id = None
         for ligne in produits:
-            try:
-                if int(ligne.get("quantity", "0")) <= int(ligne.get("min_quantity", "0")):
-                    print(ligne)
-                    trouve = True
-            except ValueError:
+            if not selectionne(ligne):
                 continue
-        if not trouve:
-            print("Aucun produit en rupture ou stock faible.")
+            selection += 1
+            selectionne_id = ligne.get("ID", "")
+            changements = []
+            nouvelle_ligne = dict(ligne)
+            for champ, op, valeur in operations:
+                nouvelle = Product._appliquer_affectation(nouvelle_ligne[champ], op, valeur, champ)
+                if nouvelle is None:
+                    print(f"Résultat non fini pour le champ '{champ}' du produit '{ligne.get('name', '')}' : "
+                          "aucune modification effectuée.")
+                    return 0
+                if nouvelle != nouvelle_ligne[champ]:
+                    changements.append(f"{champ}: {nouvelle_ligne[champ]} -> {nouvelle}")
+                    nouvelle_ligne[champ] = nouvelle
+            if not changements:
+                continue
+            modifies += 1
+            if len(apercu) < 10:
+                apercu.append(f"{ligne.get('name', '')} ({ligne.get('ID', '')}) : {', '.join(changements)}")
+            if not simulation:
+                nouvelle_ligne["updated_at"] = maintenant
+                ligne.update(nouvelle_ligne)
+
+        uniques = sorted({champ for champ, _, _ in operations if champ in Product.CHAMPS_UNIQUES})
+        if uniques and selection > 1:
+            print(f"{selection} produits sélectionnés : le(s) champ(s) {', '.join(uniques)} ne peuvent être "
+                  "modifiés en masse que pour un seul produit. Aucune modification effectuée.")
+            return 0
+        for champ, _, valeur in operations:
+            if champ == "SKU" and valeur and selection and any(
+                    p.get("ID", "") != selectionne_id and p.get("SKU", "").strip().lower() == valeur.strip().lower()
+                    for p in produits):
+                print(f"Un produit avec le SKU '{valeur}' existe déjà. Aucune modification effectuée.")
+                return 0
+        print(f"{selection} produit(s) sélectionné(s), {modifies} produit(s) {'à modifier' if simulation else 'modifié(s)'}.")
+        for ligne in apercu:
+            print(f"  {ligne}")
+        if modifies > len(apercu):
+            print(f"  ... et {modifies - len(apercu)} autre(s).")
+        if modifies and not simulation:
+            safe_write_csv(Product.CSV_FILE, Product.FIELDNAMES, produits)
+        return modifies
+
+# Classe LotManager
+
+class LotManager:
+    """Lots de coût par produit (quantité, coût unitaire, date, expiration).
+
+    Chaque produit a son dossier DOSSIER/<ID du produit>/ contenant :
+      - "etat.json" : mode de sortie, quantité, valeur, coût des ventes et, pour
+        chaque file de lots, la position de sa tête dans le journal ;
+      - un journal "<numéro>.log" par file, où chaque entrée ajoute un lot en
+        fin de fichier (une ligne JSON par lot).
+    Une sortie lit les lots à partir de la tête enregistrée et avance cette
+    position ; le journal n'est réécrit sans sa partie consommée que lorsque
+    celle-ci en représente plus de la moitié. Chaque lot est ainsi écrit, lu et
+    recopié un nombre borné de fois : le coût d'un mouvement est amorti O(1),
+    quel que soit le nombre de lots ouverts. Un journal réécrit ou vidé n'est
+    supprimé qu'après l'écriture de l'état qui ne le référence plus.
+
+    En mode "FIFO" (premier entré, premier sorti) il n'y a qu'une file. En mode
+    "FEFO" (premier expiré, premier sorti), il y a une file par date d'expiration
+    et un tas des dates ouvertes donne la prochaine file à consommer : une
+    réception hors ordre coûte O(log d), d étant le nombre de dates ouvertes.
+    """
+    DOSSIER = "les_lots"
+    MODES = ("FIFO", "FEFO")
+    # Mode des produits qui n'ont pas encore de lots.
+    MODE_DEFAUT = "FIFO"
+    # Clé de l'unique file d'un produit en mode FIFO.
+    FILE_FIFO = "fifo"
+    # Les lots sans date d'expiration sont consommés en dernier en mode FEFO.
+    EXPIRATION_MAX = "9999-12-31"
+    # Partie consommée d'un journal à partir de laquelle il peut être réécrit.
+    SEUIL_COMPACTAGE = 64 * 1024
+
+    def __init__(self):
+        self.produits = {}
+        self.modifies = set()
+        self._obsoletes = []
+        self._existants = None
+        self._hache = False
+
+    @staticmethod
+    def _nom(produit_id):
+        """Retourne le nom de dossier d'un produit (ID haché s'il n'est pas un nom sûr)."""
+        if re.fullmatch(r"[\w-]+", produit_id):
+            return produit_id
+        return "_" + hashlib.sha1(produit_id.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _dossier(produit_id):
+        return os.path.join(LotManager.DOSSIER, LotManager._nom(produit_id))
+
+    @staticmethod
+    def _journal(produit_id, numero):
+        return os.path.join(LotManager._dossier(produit_id), f"{numero}.log")
+
+    @staticmethod
+    def normaliser_expiration(expiration):
+        """Retourne la date AAAA-MM-JJ normalisée, "" si vide, ou None si elle est invalide."""
+        expiration = (expiration or "").strip()
+        if not expiration:
+            return ""
+        try:
+            return datetime.strptime(expiration, "%Y-%m-%d").date().isoformat()
+        except ValueError:
+            return None
+
+    def precharger_liste(self):
+        """Liste une fois le dossier des lots pour éviter un accès disque par produit sans lots."""
+        try:
+            self._existants = set(os.listdir(LotManager.DOSSIER))
+        except OSError:
+            self._existants = set()
+        # Les noms hachés commencent par "_" : sans eux, l'ID suffit à trouver le dossier.
+        self._hache = any(nom.startswith("_") for nom in self._existants)
+
+    def a_des_lots(self, produit_id):
+        """Indique si des lots ont déjà été enregistrés (ou chargés) pour ce produit."""
+        if produit_id in self.produits or self._existants is None:
+            return True
+        if produit_id in self._existants:
+            return True
+        return self._hache and LotManager._nom(produit_id) in self._existants
+
+    def _charger(self, produit_id):
+        etat = self.produits.get(produit_id)
+        if etat is not None:
+            return etat
+        data = {}
+        if self.a_des_lots(produit_id):
+            data = safe_read_json(os.path.join(LotManager._dossier(produit_id), "etat.json"))
+            if not isinstance(data, dict):
+                data = {}
+        files = data.get("files") if isinstance(data.get("files"), dict) else {}
+        etat = {
+            "mode": data.get("mode") if data.get("mode") in LotManager.MODES else LotManager.MODE_DEFAUT,
+            "quantite": to_int(data.get("quantite"), 0),
+            "valeur": to_float(data.get("valeur"), 0.0),
+            "cout_ventes": to_float(data.get("cout_ventes"), 0.0),
+            "journaux": to_int(data.get("journaux"), 0),
+            "files": files,
+            "ordre": [cle for cle in data.get("ordre", []) if cle in files]
+        }
+        heapq.heapify(etat["ordre"])
+        self.produits[produit_id] = etat
+        return etat
+
+    def sauver(self):
+        """Écrit l'état des seuls produits modifiés (les journaux le sont au fil des mouvements),
+        puis supprime les journaux qu'il ne référence plus."""
+        for produit_id in self.modifies:
+            etat = self.produits[produit_id]
+            os.makedirs(LotManager._dossier(produit_id), exist_ok=True)
+            safe_write_json(os.path.join(LotManager._dossier(produit_id), "etat.json"), {
+                "mode": etat["mode"],
+                "quantite": etat["quantite"],
+                "valeur": round(etat["valeur"], 6),
+                "cout_ventes": round(etat["cout_ventes"], 6),
+                "journaux": etat["journaux"],
+                "files": etat["files"],
+                "ordre": etat["ordre"]
+            }, indent=None)
+        self.modifies.clear()
+        for chemin in self._obsoletes:
+            try:
+                os.remove(chemin)
+            except OSError:
+                pass
+        self._obsoletes.clear()
+
+    @staticmethod
+    def supprimer(produit_id):
+        """Supprime les lots d'un produit."""
+        shutil.rmtree(LotManager._dossier(produit_id), ignore_errors=True)
+
+    def _etat(self, produit):
+        """Retourne l'état des lots d'un produit (ligne CSV), aligné sur sa quantité.
+
+        Un produit encore sans lots reçoit un lot d'ouverture au coût courant. Si la
+        quantité a été modifiée hors mouvement (modification directe du produit),
+        l'écart est comblé par un lot d'ajustement ou retiré en tête de file.
+        """
+        produit_id = produit.get("ID", "")
+        etat = self._charger(produit_id)
+        ecart = to_int(produit.get("quantity"), 0) - etat["quantite"]
+        if ecart > 0:
+            date = produit.get("created_at", "") if not etat["ordre"] and not etat["cout_ventes"] else now_iso()
+            self._ajouter_lot(produit_id, etat, ecart, to_float(produit.get("cost"), 0.0), date, "")
+        elif ecart < 0:
+            self._consommer(produit_id, etat, -ecart)
+        return etat
+
+    def _nouveau_journal(self, etat):
+        """Réserve le numéro d'un nouveau journal (jamais réutilisé pour ce produit)."""
+        numero = etat["journaux"]
+        etat["journaux"] += 1
+        return numero
+
+    def _empiler(self, produit_id, etat, lot):
+        """Ajoute un lot à la fin du journal de sa file (créée si besoin)."""
+        if etat["mode"] == "FEFO":
+            cle = lot.get("expiration") or LotManager.EXPIRATION_MAX
+        else:
+            cle = LotManager.FILE_FIFO
+        file_lots = etat["files"].get(cle)
+        nouvelle = file_lots is None
+        if nouvelle:
+            file_lots = {"journal": self._nouveau_journal(etat), "position": 0, "reste": None, "lots": 0}
+            etat["files"][cle] = file_lots
+            heapq.heappush(etat["ordre"], cle)
+        os.makedirs(LotManager._dossier(produit_id), exist_ok=True)
+        # Une nouvelle file repart d'un journal vide (restes éventuels d'un arrêt brutal).
+        with open(LotManager._journal(produit_id, file_lots["journal"]), "wb" if nouvelle else "ab") as f:
+            f.write((json.dumps(lot, ensure_ascii=False) + "\n").encode("utf-8"))
+        file_lots["lots"] += 1
+        self.modifies.add(produit_id)
+
+    def _ajouter_lot(self, produit_id, etat, quantite, cout_unitaire, date, expiration):
+        if quantite <= 0:
+            return
+        lot = {"quantite": quantite, "cout_unitaire": cout_unitaire, "date": date, "expiration": expiration}
+        self._empiler(produit_id, etat, lot)
+        etat["quantite"] += quantite
+        etat["valeur"] += quantite * cout_unitaire
+
+    def _fermer_file(self, produit_id, etat):
+        """Retire la file de tête, vide ; son journal sera supprimé par sauver()."""
+        cle = heapq.heappop(etat["ordre"])
+        file_lots = etat["files"].pop(cle)
+        self._obsoletes.append(LotManager._journal(produit_id, file_lots["journal"]))
+
+    def _compacter_journal(self, produit_id, etat, file_lots):
+        """Recopie la partie non consommée du journal quand elle en occupe moins de la moitié."""
+        position = file_lots["position"]
+        if position < LotManager.SEUIL_COMPACTAGE:
+            return
+        chemin = LotManager._journal(produit_id, file_lots["journal"])
+        try:
+            if position * 2 < os.path.getsize(chemin):
+                return
+            with open(chemin, "rb") as f:
+                f.seek(position)
+                suite = f.read()
+            numero = self._nouveau_journal(etat)
+            with open(LotManager._journal(produit_id, numero), "wb") as f:
+                f.write(suite)
+        except OSError as e:
+            print(f"Impossible de compacter le journal de lots {chemin} : {e}")
+            return
+        self._obsoletes.append(chemin)
+        file_lots["journal"] = numero
+        file_lots["position"] = 0
+
+    def _consommer(self, produit_id, etat, quantite):
+        """Consomme quantite unités en tête de file et retourne leur coût."""
+        reste, cout = quantite, 0.0
+        while reste > 0 and etat["ordre"]:
+            cle = etat["ordre"][0]
+            file_lots = etat["files"][cle]
+            chemin = LotManager._journal(produit_id, file_lots["journal"])
+            try:
+                with open(chemin, "rb") as f:
+                    f.seek(file_lots["position"])
+                    while reste > 0 and file_lots["lots"] > 0:
+                        ligne = f.readline()
+                        if not ligne:
+                            file_lots["lots"] = 0
+                            break
+                        lot = json.loads(ligne)
+                        dispo = lot["quantite"] if file_lots["reste"] is None else file_lots["reste"]
+                        pris = min(reste, dispo)
+                        cout += pris * lot["cout_unitaire"]
+                        reste -= pris
+                        if pris == dispo:
+                            file_lots["position"] = f.tell()
+                            file_lots["reste"] = None
+                            file_lots["lots"] -= 1
+                        else:
+                            file_lots["reste"] = dispo - pris
+            except (OSError, ValueError) as e:
+                print(f"Journal de lots illisible ({chemin}) : {e}")
+                file_lots["lots"] = 0
+            if file_lots["lots"] <= 0:
+                self._fermer_file(produit_id, etat)
+            else:
+                self._compacter_journal(produit_id, etat, file_lots)
+        etat["quantite"] -= quantite - reste
+        etat["valeur"] = etat["valeur"] - cout if etat["ordre"] else 0.0
+        self.modifies.add(produit_id)
+        return cout
+
+    def _lots_ouverts(self, produit_id, etat):
+        """Retourne les lots ouverts dans leur ordre de consommation (lecture complète)."""
+        lots = []
+        for cle in sorted(etat["ordre"]):
+            file_lots = etat["files"][cle]
+            try:
+                with open(LotManager._journal(produit_id, file_lots["journal"]), "rb") as f:
+                    f.seek(file_lots["position"])
+                    for i in range(file_lots["lots"]):
+                        ligne = f.readline()
+                        if not ligne:
+                            break
+                        lot = json.loads(ligne)
+                        if i == 0 and file_lots["reste"] is not None:
+                            lot["quantite"] = file_lots["reste"]
+                        lots.append(lot)
+            except (OSError, ValueError) as e:
+                print(f"Journal de lots illisible : {e}")
+        return lots
+
+    def entree(self, produit, quantite, cout_unitaire, expiration=""):
+        """Crée un lot pour une entrée en stock (avant mise à jour de la quantité du produit)."""
+        if quantite <= 0:
+            print("La quantité d'un lot doit être strictement positive.")
+            return False
+        expiration = LotManager.normaliser_expiration(expiration)
+        if expiration is None:
+            print("Date d'expiration invalide (format attendu : AAAA-MM-JJ).")
+            return False
+        etat = self._etat(produit)
+        self._ajouter_lot(produit.get("ID", ""), etat, quantite, cout_unitaire, now_iso(), expiration)
+        return True
+
+    def sortie(self, produit, quantite):
+        """Consomme les lots pour une sortie de stock et retourne le coût des marchandises vendues."""
+        if quantite <= 0:
+            return 0.0
+        etat = self._etat(produit)
+        cout = self._consommer(produit.get("ID", ""), etat, quantite)
+        etat["cout_ventes"] += cout
+        return cout
+
+    def valeur(self, produit):
+        """Retourne (valeur du stock, coût des ventes cumulé) d'un produit."""
+        etat = self._etat(produit)
+        return etat["valeur"], etat["cout_ventes"]
+
+    def definir_mode(self, produit, mode):
+        """Change le mode de sortie d'un produit et réordonne une fois ses lots en conséquence."""
+        produit_id = produit.get("ID", "")
+        etat = self._etat(produit)
+        if etat["mode"] == mode:
+            return
+        # Tri stable par date d'entrée : en FEFO, chaque file d'expiration reste FIFO.
+        lots = sorted(self._lots_ouverts(produit_id, etat), key=lambda lot: lot.get("date", ""))
+        while etat["ordre"]:
+            self._fermer_file(produit_id, etat)
+        etat["mode"] = mode
+        for lot in lots:
+            self._empiler(produit_id, etat, lot)
+        self.modifies.add(produit_id)
+
+    @staticmethod
+    def _trouver_produit(nom_produit_or_id):
+        cible = nom_produit_or_id.strip().lower()
+        _, trouves = Product._selectionner_produits(
+            ("ID", "name"), lambda produit_id, name: cible in (produit_id.strip().lower(), name.strip().lower()))
+        return trouves[0] if trouves else None
+
+    @staticmethod
+    def changer_mode(nom_produit_or_id, mode):
+        """Définit le mode de sortie (FIFO/FEFO) d'un produit."""
+        mode = mode.strip().upper()
+        if mode not in LotManager.MODES:
+            print(f"Mode inconnu ({'/'.join(LotManager.MODES)}).")
+            return
+        p = LotManager._trouver_produit(nom_produit_or_id)
+        if p is None:
+            print(f"Produit '{nom_produit_or_id}' introuvable.")
+            return
+        lots = LotManager()
+        lots.definir_mode(p, mode)
+        lots.sauver()
+        print(f"Mode de sortie de '{p.get('name', '')}' : {mode}.")
+
+    @staticmethod
+    def afficher_lots(nom_produit_or_id):
+        """Affiche les lots ouverts d'un produit dans leur ordre de consommation."""
+        p = LotManager._trouver_produit(nom_produit_or_id)
+        if p is None:
+            print(f"Produit '{nom_produit_or_id}' introuvable.")
+            return
+        gestion = LotManager()
+        etat = gestion._etat(p)
+        gestion.sauver()
+        lots = gestion._lots_ouverts(p.get("ID", ""), etat)
+        if not lots:
+            print(f"Aucun lot ouvert pour '{p.get('name', '')}'.")
+            return
+        print(f"\nLots de '{p.get('name', '')}' ({etat['mode']}) :")
+        for lot in lots:
+            print(lot)
+        print(f"Quantité : {etat['quantite']} - Valeur : {etat['valeur']:.2f}")
 
 # Classe StockManager
 
 class StockManager:
     HISTORIQUE_FILE = "historique_mouvements.json"
+    AGREGATS_FILE = "historique_agrege.json"
+    # Nombre de jours pendant lesquels les mouvements sont conservés tels quels ;
+    # au-delà ils sont regroupés en agrégats journaliers par produit.
+    RETENTION_JOURS = 90
 
     @staticmethod
     def _charger_historique():
@@ -436,9 +1274,140 @@ class StockManager:
         safe_write_json(StockManager.HISTORIQUE_FILE, historique)
 
     @staticmethod
-    def mise_a_jour_stock(nom_produit_or_id, quantite, type_mouvement):
-        """Met à jour le stock d'un produit."""
+    def _charger_agregats():
+        """Retourne les agrégats, ou None si le fichier existe mais est illisible."""
+        agregats = safe_read_json(StockManager.AGREGATS_FILE, strict=True)
+        return agregats if isinstance(agregats, list) else None
+
+    @staticmethod
+    def _sauver_agregats(agregats):
+        return safe_write_json(StockManager.AGREGATS_FILE, agregats, indent=None)
+
+    @staticmethod
+    def _date_limite(jours=None):
+        """Retourne la date (AAAA-MM-JJ) avant laquelle les mouvements sont agrégés."""
+        jours = StockManager.RETENTION_JOURS if jours is None else max(0, to_int(jours, StockManager.RETENTION_JOURS))
+        return (datetime.utcnow() - timedelta(days=jours)).date().isoformat()
+
+    @staticmethod
+    def _appliquer_retention(historique, jours=None):
+        """Agrège les mouvements antérieurs à la fenêtre de rétention.
+
+        Les mouvements sont regroupés par produit et par jour (entrées, sorties,
+        quantités d'ouverture et de clôture) puis fusionnés avec les agrégats existants.
+        Chaque agrégat retient l'horodatage du dernier mouvement absorbé : si le
+        programme s'arrête entre l'écriture des agrégats et celle de l'historique
+        réduit, les mouvements déjà agrégés sont ignorés au passage suivant.
+        L'historique n'est réduit que si les agrégats ont bien été écrits ; rien
+        n'est fait si le fichier d'agrégats existant est illisible.
+        Retourne (mouvements conservés, nombre de mouvements agrégés), ce nombre
+        valant None si le compactage a été annulé.
+        """
+        limite = StockManager._date_limite(jours)
+        # L'historique est chronologique : rien à faire si le plus ancien est récent.
+        if not historique or historique[0].get("timestamp", "") >= limite:
+            return historique, 0
+        anciens = [e for e in historique if e.get("timestamp", "") < limite]
+        recents = [e for e in historique if e.get("timestamp", "") >= limite]
+
+        agregats = StockManager._charger_agregats()
+        if agregats is None:
+            print(f"Fichier {StockManager.AGREGATS_FILE} illisible : compactage de l'historique annulé.")
+            return historique, None
+        index = {(a.get("produit_id", ""), a.get("date", "")): a for a in agregats}
+        for e in anciens:
+            cle = (e.get("produit_id", ""), e.get("timestamp", "")[:10])
+            a = index.get(cle)
+            if a is not None and e.get("timestamp", "") <= a.get("dernier_mouvement", ""):
+                continue
+            if a is None:
+                a = {
+                    "date": cle[1],
+                    "produit": e.get("produit", ""),
+                    "produit_id": cle[0],
+                    "entrees": 0,
+                    "sorties": 0,
+                    "cout_sorties": 0.0,
+                    "nb_mouvements": 0,
+                    "qte_ouverture": to_int(e.get("ancienne_qte"), 0),
+                    "qte_cloture": to_int(e.get("ancienne_qte"), 0)
+                }
+                index[cle] = a
+                agregats.append(a)
+            q = to_int(e.get("quantite"), 0)
+            if e.get("mouvement") == "ajout":
+                a["entrees"] += q
+            elif e.get("mouvement") == "retrait":
+                a["sorties"] += q
+                a["cout_sorties"] = round(a.get("cout_sorties", 0.0) + to_float(e.get("cout_sortie"), 0.0), 2)
+            a["nb_mouvements"] += 1
+            a["produit"] = e.get("produit", a["produit"])
+            a["qte_cloture"] = to_int(e.get("nouvelle_qte"), a["qte_cloture"])
+            a["dernier_mouvement"] = e.get("timestamp", "")
+        agregats.sort(key=lambda a: (a.get("date", ""), a.get("produit_id", "")))
+        if not StockManager._sauver_agregats(agregats):
+            print("Compactage de l'historique annulé : les mouvements détaillés sont conservés.")
+            return historique, None
+        return recents, len(anciens)
+
+    @staticmethod
+    def compacter_historique(jours=None):
+        """Agrège dans le fichier compact les mouvements plus anciens que la rétention."""
+        historique, nb = StockManager._appliquer_retention(StockManager._charger_historique(), jours)
+        if nb is None:
+            return 0
+        if not nb:
+            print("Aucun mouvement à compacter.")
+            return 0
+        StockManager._sauver_historique(historique)
+        print(f"{nb} mouvement(s) agrégé(s), {len(historique)} mouvement(s) détaillé(s) conservé(s).")
+        return nb
+
+    @staticmethod
+    def historique_complet(produit_name_or_id=None):
+        """Retourne l'historique agrégé puis détaillé, éventuellement filtré par produit.
+
+        Les agrégats sont présentés comme des mouvements de type "agrege" afin que
+        l'ensemble reste lisible dans l'ordre chronologique.
+        """
+        cible = produit_name_or_id.strip().lower() if produit_name_or_id else ""
+
+        def concerne(e):
+            return (not cible or e.get("produit_id", "").strip().lower() == cible or
+                    e.get("produit", "").strip().lower() == cible)
+
+        resultat = []
+        for a in StockManager._charger_agregats() or []:
+            if concerne(a):
+                e = {"timestamp": a.get("date", ""), "mouvement": "agrege"}
+                e.update(a)
+                del e["date"]
+                resultat.append(e)
+        resultat.extend(e for e in StockManager._charger_historique() if concerne(e))
+        return resultat
+
+    @staticmethod
+    def mise_a_jour_stock(nom_produit_or_id, quantite, type_mouvement, cout_unitaire=None, expiration=""):
+        """Met à jour le stock d'un produit.
+
+        Un ajout crée un lot au coût unitaire indiqué (coût actuel du produit par
+        défaut) ; un retrait consomme les lots selon le mode de sortie du produit.
+        """
+        q = to_int(quantite, 0)
+        if q <= 0:
+            print("La quantité doit être un entier strictement positif.")
+            return
+        expiration = LotManager.normaliser_expiration(expiration)
+        if expiration is None:
+            print("Date d'expiration invalide (format attendu : AAAA-MM-JJ).")
+            return
+        if cout_unitaire not in (None, ""):
+            cout_unitaire = to_float(cout_unitaire, None)
+            if cout_unitaire is None or cout_unitaire < 0:
+                print("Le coût unitaire doit être un nombre positif.")
+                return
         produits = Product._charger_produits()
+        lots = LotManager()
         modifie = False
         for p in produits:
             if (p.get("name", "").strip().lower() == nom_produit_or_id.strip().lower() or
@@ -447,7 +1416,6 @@ class StockManager:
                     ancienne_qte = int(p.get("quantity", "0"))
                 except ValueError:
                     ancienne_qte = 0
-                q = to_int(quantite, 0)
                 if type_mouvement == "ajout":
                     nouvelle_qte = ancienne_qte + q
                 elif type_mouvement == "retrait":
@@ -456,10 +1424,7 @@ class StockManager:
                     print("Type de mouvement inconnu (ajout/retrait).")
                     return
 
-                p["quantity"] = str(nouvelle_qte)
-                p["updated_at"] = now_iso()
-                historique = StockManager._charger_historique()
-                historique.append({
+                mouvement = {
                     "timestamp": now_iso(),
                     "produit": p.get("name", ""),
                     "produit_id": p.get("ID", ""),
@@ -467,19 +1432,33 @@ class StockManager:
                     "quantite": q,
                     "ancienne_qte": ancienne_qte,
                     "nouvelle_qte": nouvelle_qte
-                })
+                }
+                if type_mouvement == "ajout":
+                    cout = to_float(p.get("cost", ""), 0.0) if cout_unitaire in (None, "") else cout_unitaire
+                    lots.entree(p, q, cout, expiration)
+                    p["cost"] = str(cout)
+                    mouvement["cout_unitaire"] = cout
+                else:
+                    mouvement["cout_sortie"] = round(lots.sortie(p, ancienne_qte - nouvelle_qte), 2)
+
+                p["quantity"] = str(nouvelle_qte)
+                p["updated_at"] = now_iso()
+                historique = StockManager._charger_historique()
+                historique.append(mouvement)
+                historique, _ = StockManager._appliquer_retention(historique)
                 StockManager._sauver_historique(historique)
                 modifie = True
         if modifie:
             safe_write_csv(Product.CSV_FILE, Product.FIELDNAMES, produits)
+            lots.sauver()
             print("Stock mis à jour avec succès.")
         else:
             print(f"Produit '{nom_produit_or_id}' introuvable.")
 
     @staticmethod
-    def consulter_historique():
-        """Consulte l'historique des mouvements de stock."""
-        h = StockManager._charger_historique()
+    def consulter_historique(produit_name_or_id=None):
+        """Consulte l'historique des mouvements de stock (agrégats journaliers inclus)."""
+        h = StockManager.historique_complet(produit_name_or_id)
         if not h:
             print("Aucun mouvement enregistré.")
             return
@@ -489,15 +1468,27 @@ class StockManager:
 
     @staticmethod
     def valorisation_totale():
-        """Calcule et affiche la valeur totale du stock."""
-        produits = Product._charger_produits()
-        total = 0.0
-        for p in produits:
-            try:
-                total += int(p.get("quantity", "0")) * float(p.get("cost", "0.0"))
-            except Exception:
+        """Calcule et affiche la valeur du stock et le coût des ventes à partir des lots."""
+        noms = ("ID", "quantity", "cost", "created_at")
+        colonnes = lire_colonnes_csv(Product.CSV_FILE, Product.FIELDNAMES, noms)
+        lots = LotManager()
+        lots.precharger_liste()
+        total, cout_ventes = 0.0, 0.0
+        for ligne in zip(*(colonnes[nom] for nom in noms)):
+            if not lots.a_des_lots(ligne[0]):
+                # Aucun lot enregistré : tout le stock est valorisé au coût courant.
+                try:
+                    total += int(ligne[1]) * float(ligne[2])
+                except ValueError:
+                    pass
                 continue
+            valeur, cout = lots.valeur(dict(zip(noms, ligne)))
+            total += valeur
+            cout_ventes += cout
+        # Enregistre les alignements éventuels (quantités modifiées hors mouvement).
+        lots.sauver()
         print(f"Valeur totale du stock : {total:.2f}")
+        print(f"Coût des marchandises vendues : {cout_ventes:.2f}")
 
 # ---------------------------
 # Menus
@@ -514,6 +1505,7 @@ def menu_produits():
         print("6. Afficher les produits par catégorie")
         print("7. Afficher les produits par fournisseur")
         print("8. Afficher les produits en stock faible")
+        print("9. Modification en masse")
         print("0. Retour")
 
         choix = input("Votre choix : ").strip()
@@ -577,6 +1569,21 @@ def menu_produits():
         elif choix == "8":
             Product.produits_stock_faible()
 
+        elif choix == "9":
+            print("Filtres (laisser vide pour ignorer) :")
+            filtres = {
+                "categorie": input("  Catégorie (ID ou nom) : ").strip(),
+                "fournisseur": input("  Fournisseur (ID ou nom) : ").strip(),
+                "prix_min": input("  Prix minimum : ").strip(),
+                "prix_max": input("  Prix maximum : ").strip(),
+                "stock_faible": input("  Stock faible uniquement (o/n) : ").strip().lower() == "o",
+                "motif": input("  Motif de nom (ex. pom*) : ").strip()
+            }
+            affectations = input("Affectations séparées par ';' (ex. price *= 1.03; min_quantity = 10) : ").strip()
+            if Product.modifier_produits_en_masse(affectations, simulation=True, **filtres):
+                if input("Appliquer ces modifications ? (o/n) : ").strip().lower() == "o":
+                    Product.modifier_produits_en_masse(affectations, **filtres)
+
         elif choix == "0":
             break
         else:
@@ -668,6 +1675,9 @@ def menu_stocks():
         print("2. Afficher les alertes de stock faible")
         print("3. Consulter l'historique des mouvements")
         print("4. Valorisation du stock")
+        print("5. Compacter l'historique")
+        print("6. Consulter les lots d'un produit")
+        print("7. Mode de sortie d'un produit (FIFO/FEFO)")
         print("0. Retour")
 
         choix = input("Votre choix : ").strip()
@@ -676,17 +1686,35 @@ def menu_stocks():
             nom = input("Nom ou ID du produit : ").strip()
             type_mvt = input("Type de mouvement (ajout/retrait) : ").strip().lower()
             qte = input("Quantité : ").strip()
-            StockManager.mise_a_jour_stock(nom, qte, type_mvt)
+            cout, expiration = None, ""
+            if type_mvt == "ajout":
+                cout = input("Coût unitaire (laisser vide pour le coût actuel) : ").strip() or None
+                expiration = input("Date d'expiration (AAAA-MM-JJ, optionnelle) : ").strip()
+            StockManager.mise_a_jour_stock(nom, qte, type_mvt, cout, expiration)
 
         elif choix == "2":
             Product.produits_stock_faible()
 
         elif choix == "3":
-            StockManager.consulter_historique()
+            produit = input("Produit (nom ou ID, laisser vide pour tout) : ").strip()
+            StockManager.consulter_historique(produit)
 
         elif choix == "4":
             StockManager.valorisation_totale()
 
+        elif choix == "5":
+            jours = input(f"Jours à conserver en détail (défaut {StockManager.RETENTION_JOURS}) : ").strip()
+            StockManager.compacter_historique(jours or None)
+
+        elif choix == "6":
+            nom = input("Nom ou ID du produit : ").strip()
+            LotManager.afficher_lots(nom)
+
+        elif choix == "7":
+            nom = input("Nom ou ID du produit : ").strip()
+            mode = input("Mode de sortie (FIFO/FEFO) : ").strip()
+            LotManager.changer_mode(nom, mode)
+
         elif choix == "0":
             break
         else:
@@ -731,5 +1759,8 @@ if __name__ == "__main__":
         safe_write_csv(Product.CSV_FILE, Product.FIELDNAMES, [])
     if not os.path.exists(StockManager.HISTORIQUE_FILE):
         safe_write_json(StockManager.HISTORIQUE_FILE, [])
+    if not os.path.exists(StockManager.AGREGATS_FILE):
+        safe_write_json(StockManager.AGREGATS_FILE, [], indent=None)
+    os.makedirs(LotManager.DOSSIER, exist_ok=True)
 
     menu()